@@ -0,0 +1,614 @@
+# ======================================================
+# 🔁 K-Fold / Hyperparameter Sweep Runner
+#      (BioClinicalBERT severity + ViT image models)
+# ======================================================
+#
+# train_bert.py / train_vit.py train a single configuration on a single
+# split and redo tokenization, image transforms and model download on every
+# run. This script does that work ONCE into a cache directory and then runs
+# every (hyperparameter config x fold) trial in parallel worker processes that
+# only read from the cache.
+#
+# Example:
+#   python train_sweep.py --task bert --folds 5 \
+#       --learning-rates 2e-5 3e-5 --epochs 3 4 --threads-per-worker 2
+#
+#   python train_sweep.py --task vit --folds 3 --learning-rates 5e-5 \
+#       --batch-sizes 4 8 --workers 2
+#
+# Only the downloaded base checkpoint is cached; the classification head is
+# freshly initialized inside each trial from --seed, as in the original scripts.
+#
+# Results (one row per trial + a per-config summary) are written as CSV
+# files next to the cache.
+
+import os
+os.environ["WANDB_DISABLED"] = "true"
+os.environ["WANDB_MODE"] = "disabled"
+
+import argparse
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import torch
+from datasets import Array3D, ClassLabel, Dataset, Features, load_dataset, load_from_disk
+from sklearn.model_selection import KFold, train_test_split
+from sklearn.preprocessing import LabelEncoder
+from torchvision import transforms
+from transformers import (
+    AutoImageProcessor,
+    AutoModel,
+    AutoModelForImageClassification,
+    AutoModelForSequenceClassification,
+    AutoTokenizer,
+    DataCollatorWithPadding,
+    Trainer,
+    TrainingArguments,
+    set_seed,
+)
+
+# ------------------------------------------------------
+# 1. TASK DEFAULTS
+# ------------------------------------------------------
+TASKS = {
+    "bert": {
+        "model_name": "emilyalsentzer/Bio_ClinicalBERT",
+        "data_path": "severity_classification_dataset.csv",
+        "learning_rate": 2e-5,
+        "batch_size": 8,
+        "epochs": 4,
+    },
+    "vit": {
+        "model_name": "google/vit-base-patch16-224",
+        "data_path": "Multimodal_images/Multimodal_images",
+        "learning_rate": 5e-5,
+        "batch_size": 4,
+        "epochs": 5,
+    },
+}
+
+# Every BLAS / OpenMP backend torch, numpy or tokenizers may pull in.
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+)
+
+CACHE_META = "cache_meta.json"
+
+# Rough peak RAM of one BERT-base / ViT-base fine-tune with AdamW
+TRIAL_MEMORY_GB = 2.0
+
+
+# ------------------------------------------------------
+# 2. THREAD LIMITS
+# ------------------------------------------------------
+def limit_threads(num_threads):
+    """Cap every threaded backend so parallel workers don't oversubscribe."""
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(num_threads)
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    torch.set_num_threads(num_threads)
+
+
+def available_cpus():
+    """CPUs this process may run on (respects affinity / container cpusets)."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory_gb():
+    """
+    Memory new workers can use in GB, or None where it can't be read.
+
+    Uses MemAvailable (which counts reclaimable page cache, unlike MemFree),
+    capped by the cgroup v2 limit when running in a container.
+    """
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        available = int(meminfo["MemAvailable"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+    try:
+        with open("/sys/fs/cgroup/memory.max") as f:
+            limit = f.read().strip()
+        if limit != "max":
+            available = min(available, int(limit))
+    except (OSError, ValueError):
+        pass
+    return available / 1024 ** 3
+
+
+def default_workers(threads_per_worker, trial_memory_gb):
+    if torch.cuda.is_available():
+        # Trials would all land on cuda:0 and fight over its memory
+        return 1
+    workers = available_cpus() // threads_per_worker
+    memory_gb = available_memory_gb()
+    if memory_gb is not None:
+        # An OOM-killed worker breaks the whole pool, failing every trial
+        memory_workers = int(memory_gb // trial_memory_gb)
+        if memory_workers < workers:
+            print(f"[NOTE] Limiting to {max(1, memory_workers)} worker(s): "
+                  f"{memory_gb:.1f} GB available / {trial_memory_gb} GB per trial "
+                  f"(CPUs allow {workers}). Override with --workers or --trial-memory-gb.")
+            workers = memory_workers
+    return max(1, workers)
+
+
+def init_worker(num_threads):
+    limit_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Already fixed once inter-op work has started in this process
+        pass
+
+
+# ------------------------------------------------------
+# 3. SHARED PREPROCESSED CACHE (BUILT ONCE)
+# ------------------------------------------------------
+def build_bert_cache(model_name, data_path, model_dir, num_proc):
+    df = pd.read_csv(data_path)
+    df["Condition"] = df["Condition"].str.lower()
+    df["Severity"] = df["Severity"].str.capitalize()
+
+    df = df[["Condition", "Severity"]].dropna().reset_index(drop=True)
+    df.rename(columns={"Condition": "text", "Severity": "label"}, inplace=True)
+
+    encoder = LabelEncoder()
+    df["label"] = encoder.fit_transform(df["label"])
+    label_names = [str(name) for name in encoder.classes_]
+
+    # Base encoder only: the classification head is built per trial
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    tokenizer.save_pretrained(model_dir)
+    model.save_pretrained(model_dir)
+
+    # No padding here: DataCollatorWithPadding pads per batch at train time
+    def preprocess_function(examples):
+        return tokenizer(examples["text"], truncation=True, max_length=128)
+
+    dataset = Dataset.from_pandas(df)
+    dataset = dataset.map(
+        preprocess_function,
+        batched=True,
+        num_proc=num_proc,
+        remove_columns=["text"],
+    )
+    return dataset, label_names
+
+
+def build_vit_cache(model_name, data_path, model_dir, num_proc):
+    dataset = load_dataset("imagefolder", data_dir=data_path)["train"]
+    label_names = dataset.features["label"].names
+
+    # Checkpoint as downloaded: its head is replaced per trial
+    processor = AutoImageProcessor.from_pretrained(model_name)
+    model = AutoModelForImageClassification.from_pretrained(model_name)
+    processor.save_pretrained(model_dir)
+    model.save_pretrained(model_dir)
+
+    image_size = 224
+    resize = transforms.Resize((image_size, image_size))
+
+    def transform(batch):
+        images = [resize(image.convert("RGB")) for image in batch["image"]]
+        inputs = processor(images, return_tensors="np")
+        return {"pixel_values": list(inputs["pixel_values"])}
+
+    # Fixed-shape column: trials read tensors straight from Arrow instead of
+    # converting nested lists on every access
+    features = Features({
+        "label": ClassLabel(names=label_names),
+        "pixel_values": Array3D(shape=(3, image_size, image_size), dtype="float32"),
+    })
+
+    # Drop the raw images: trials only ever need the tensors
+    dataset = dataset.map(
+        transform,
+        batched=True,
+        batch_size=32,
+        num_proc=num_proc,
+        remove_columns=["image"],
+        features=features,
+    )
+    return dataset, label_names
+
+
+def data_fingerprint(data_path):
+    """Hash of file names, sizes and mtimes under data_path (a file or a folder)."""
+    if os.path.isfile(data_path):
+        paths = [data_path]
+    else:
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(data_path)
+            for name in names
+        )
+
+    digest = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        rel_path = os.path.relpath(path, data_path)
+        digest.update(f"{rel_path}|{stat.st_size}|{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+CACHE_BUILDERS = {
+    "bert": build_bert_cache,
+    "vit": build_vit_cache,
+}
+
+
+def prepare_cache(task, model_name, data_path, cache_dir, num_proc, rebuild=False):
+    """
+    Tokenize / transform the data and download the base model once.
+
+    Subsequent runs with the same task, model and data reuse the cache, so a
+    sweep only pays the preprocessing cost the first time.
+    """
+    meta = {
+        "task": task,
+        "model_name": model_name,
+        "data_path": os.path.abspath(data_path),
+        # Edited CSV rows or added / removed images must invalidate the cache
+        "data_fingerprint": data_fingerprint(data_path),
+    }
+    meta_path = os.path.join(cache_dir, CACHE_META)
+    dataset_dir = os.path.join(cache_dir, "dataset")
+    model_dir = os.path.join(cache_dir, "model")
+
+    if not rebuild and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            cached = json.load(f)
+        if all(cached.get(key) == value for key, value in meta.items()):
+            print(f"[OK] Reusing preprocessed cache at {cache_dir}")
+            return dataset_dir, model_dir, cached["label_names"]
+
+    print(f"Building preprocessed cache at {cache_dir} ...")
+    start = time.perf_counter()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # Invalidate first: model/ and dataset/ are overwritten in place below
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    dataset, label_names = CACHE_BUILDERS[task](model_name, data_path, model_dir, num_proc)
+    dataset.save_to_disk(dataset_dir)
+
+    # Written last, so a cache is only valid once the whole build has finished
+    meta["label_names"] = label_names
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+
+    print(f"[OK] Cache built in {time.perf_counter() - start:.1f}s")
+    return dataset_dir, model_dir, label_names
+
+
+# ------------------------------------------------------
+# 4. TRIALS (CONFIG x FOLD)
+# ------------------------------------------------------
+def make_splits(task, num_rows, folds, seed):
+    indices = np.arange(num_rows)
+    if folds < 2 and task == "vit":
+        # Same single 80/20 split as train_vit.py, which shuffles with the
+        # datasets library's generator rather than sklearn's
+        split = Dataset.from_dict({"idx": indices}).train_test_split(
+            test_size=0.2, seed=seed, keep_in_memory=True
+        )
+        return [(np.array(split["train"]["idx"]), np.array(split["test"]["idx"]))]
+    if folds < 2:
+        # Same single 80/20 split as train_bert.py
+        train_idx, test_idx = train_test_split(indices, test_size=0.2, random_state=seed)
+        return [(train_idx, test_idx)]
+    kfold = KFold(n_splits=folds, shuffle=True, random_state=seed)
+    return list(kfold.split(indices))
+
+
+def make_grid(args, defaults):
+    grid = {
+        "learning_rate": args.learning_rates or [defaults["learning_rate"]],
+        "batch_size": args.batch_sizes or [defaults["batch_size"]],
+        "epochs": args.epochs or [defaults["epochs"]],
+        "weight_decay": args.weight_decays,
+        "grad_accum": args.grad_accum,
+    }
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in itertools.product(*grid.values())]
+
+
+def compute_metrics(eval_pred):
+    logits, labels = eval_pred
+    preds = np.argmax(logits, axis=-1)
+    return {"accuracy": float((preds == labels).mean())}
+
+
+def vit_collate_fn(batch):
+    pixel_values = torch.stack([x["pixel_values"] for x in batch])
+    labels = torch.tensor([x["label"] for x in batch])
+    return {"pixel_values": pixel_values, "labels": labels}
+
+
+def run_trial(trial):
+    """Train and evaluate one config on one fold. Runs inside a worker."""
+    start = time.perf_counter()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    # Memory-mapped Arrow files: every worker shares the same page cache
+    dataset = load_from_disk(trial["dataset_dir"])
+    train_dataset = dataset.select(trial["train_idx"])
+    eval_dataset = dataset.select(trial["eval_idx"])
+
+    label_names = trial["label_names"]
+    head_kwargs = {
+        "num_labels": len(label_names),
+        "id2label": {i: name for i, name in enumerate(label_names)},
+        "label2id": {name: i for i, name in enumerate(label_names)},
+        "local_files_only": True,
+    }
+
+    # Seed before building the model so the new head's init follows --seed
+    set_seed(trial["seed"])
+    if trial["task"] == "bert":
+        tokenizer = AutoTokenizer.from_pretrained(trial["model_dir"], local_files_only=True)
+        model = AutoModelForSequenceClassification.from_pretrained(
+            trial["model_dir"], **head_kwargs
+        )
+        data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
+    else:
+        train_dataset.set_format("torch", columns=["pixel_values", "label"])
+        eval_dataset.set_format("torch", columns=["pixel_values", "label"])
+        model = AutoModelForImageClassification.from_pretrained(
+            trial["model_dir"], ignore_mismatched_sizes=True, **head_kwargs
+        )
+        data_collator = vit_collate_fn
+
+    config = trial["config"]
+    training_args = TrainingArguments(
+        output_dir=trial["output_dir"],
+
+        per_device_train_batch_size=config["batch_size"],
+        per_device_eval_batch_size=config["batch_size"],
+        num_train_epochs=config["epochs"],
+        learning_rate=config["learning_rate"],
+        weight_decay=config["weight_decay"],
+        gradient_accumulation_steps=config["grad_accum"],
+
+        optim="adamw_torch",
+        lr_scheduler_type="cosine",
+        warmup_ratio=0.1,
+        fp16=True if device == "cuda" else False,
+        max_grad_norm=1.0,
+        seed=trial["seed"],
+
+        # Workers are already parallel; extra loader processes would oversubscribe
+        dataloader_num_workers=0,
+
+        # Only the final metrics matter for a sweep
+        save_strategy="no",
+        logging_strategy="no",
+        disable_tqdm=True,
+        report_to=[],
+    )
+
+    trainer = Trainer(
+        model=model,
+        args=training_args,
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=data_collator,
+        compute_metrics=compute_metrics,
+    )
+    train_output = trainer.train()
+    metrics = trainer.evaluate()
+
+    return {
+        "config_id": trial["config_id"],
+        "fold": trial["fold"],
+        **config,
+        "train_loss": train_output.training_loss,
+        "eval_loss": metrics.get("eval_loss"),
+        "eval_accuracy": metrics.get("eval_accuracy"),
+        "train_size": len(trial["train_idx"]),
+        "eval_size": len(trial["eval_idx"]),
+        "wall_clock_s": round(time.perf_counter() - start, 2),
+        "worker_pid": os.getpid(),
+    }
+
+
+# ------------------------------------------------------
+# 5. PARALLEL SWEEP
+# ------------------------------------------------------
+def run_sweep(trials, workers, threads_per_worker):
+    # Set before the pool starts so spawned workers inherit the limits
+    # before torch initialises its thread pools
+    limit_threads(threads_per_worker)
+    # Same for offline mode: transformers / datasets read these at import time,
+    # which in a spawned worker happens before the initializer runs.
+    # Everything a trial needs is already in the shared cache.
+    os.environ["HF_HUB_OFFLINE"] = "1"
+    os.environ["HF_DATASETS_OFFLINE"] = "1"
+
+    results = []
+    ctx = mp.get_context("spawn")
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=ctx,
+        initializer=init_worker,
+        initargs=(threads_per_worker,),
+    ) as executor:
+        futures = {executor.submit(run_trial, trial): trial for trial in trials}
+        for future in as_completed(futures):
+            trial = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"[ERROR] config {trial['config_id']} fold {trial['fold']}: {e}")
+                result = {
+                    "config_id": trial["config_id"],
+                    "fold": trial["fold"],
+                    **trial["config"],
+                    "error": str(e),
+                }
+            else:
+                print(
+                    f"[OK] config {result['config_id']} fold {result['fold']}: "
+                    f"acc={result['eval_accuracy']:.4f} ({result['wall_clock_s']}s)"
+                )
+            results.append(result)
+    return results
+
+
+def summarize(results_df):
+    config_cols = [
+        "config_id", "learning_rate", "batch_size", "epochs", "weight_decay", "grad_accum",
+    ]
+    ok = results_df
+    if "error" in ok.columns:
+        ok = ok[ok["error"].isna()]
+    if ok.empty:
+        return ok
+    return (
+        ok.groupby(config_cols)
+        .agg(
+            folds=("fold", "count"),
+            mean_accuracy=("eval_accuracy", "mean"),
+            std_accuracy=("eval_accuracy", "std"),
+            mean_eval_loss=("eval_loss", "mean"),
+            total_wall_clock_s=("wall_clock_s", "sum"),
+        )
+        .reset_index()
+        .sort_values("mean_accuracy", ascending=False)
+    )
+
+
+# ------------------------------------------------------
+# 6. ENTRY POINT
+# ------------------------------------------------------
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Parallel k-fold / hyperparameter sweep over a shared preprocessed cache"
+    )
+    parser.add_argument("--task", choices=sorted(TASKS), required=True)
+    parser.add_argument("--data-path", help="CSV (bert) or image folder (vit)")
+    parser.add_argument("--model-name")
+    parser.add_argument("--cache-dir", help="Defaults to ./sweep_cache/<task>")
+    parser.add_argument("--rebuild-cache", action="store_true")
+    parser.add_argument("--folds", type=int, default=5,
+                        help="K for k-fold CV; 1 uses a single 80/20 split")
+    parser.add_argument("--seed", type=int, default=42)
+
+    parser.add_argument("--learning-rates", type=float, nargs="+")
+    parser.add_argument("--batch-sizes", type=int, nargs="+")
+    parser.add_argument("--epochs", type=int, nargs="+")
+    parser.add_argument("--weight-decays", type=float, nargs="+", default=[0.01])
+    parser.add_argument("--grad-accum", type=int, nargs="+", default=[2],
+                        help="Gradient accumulation steps (train_bert.py / train_vit.py use 2)")
+
+    parser.add_argument("--threads-per-worker", type=int, default=2)
+    parser.add_argument("--workers", type=int,
+                        help="Parallel trials; defaults to usable CPUs / threads-per-worker, "
+                             "capped by free memory / trial-memory-gb (1 on GPU)")
+    parser.add_argument("--trial-memory-gb", type=float, default=TRIAL_MEMORY_GB,
+                        help="Estimated RAM per trial, used for the default worker count")
+    parser.add_argument("--preprocess-workers", type=int, default=1,
+                        help="Processes used once to build the cache")
+    args = parser.parse_args()
+
+    positive = {
+        "--folds": [args.folds],
+        "--threads-per-worker": [args.threads_per_worker],
+        "--preprocess-workers": [args.preprocess_workers],
+        "--workers": [args.workers] if args.workers is not None else [],
+        "--batch-sizes": args.batch_sizes or [],
+        "--epochs": args.epochs or [],
+        "--grad-accum": args.grad_accum,
+    }
+    for flag, values in positive.items():
+        if any(value < 1 for value in values):
+            parser.error(f"{flag} must be at least 1")
+    if args.trial_memory_gb <= 0:
+        parser.error("--trial-memory-gb must be positive")
+    return args
+
+
+def main():
+    args = parse_args()
+    defaults = TASKS[args.task]
+    model_name = args.model_name or defaults["model_name"]
+    data_path = args.data_path or defaults["data_path"]
+    cache_dir = args.cache_dir or os.path.join("sweep_cache", args.task)
+
+    print(f"\n>>> Sweep: {args.task.upper()} <<<\n")
+
+    dataset_dir, model_dir, label_names = prepare_cache(
+        args.task, model_name, data_path, cache_dir,
+        num_proc=args.preprocess_workers if args.preprocess_workers > 1 else None,
+        rebuild=args.rebuild_cache,
+    )
+    print("Classes:", label_names)
+
+    num_rows = load_from_disk(dataset_dir).num_rows
+    if args.folds > num_rows:
+        raise SystemExit(
+            f"[ERROR] --folds {args.folds} is more than the {num_rows} rows in the dataset."
+        )
+    splits = make_splits(args.task, num_rows, args.folds, args.seed)
+    grid = make_grid(args, defaults)
+
+    trials = []
+    for config_id, config in enumerate(grid):
+        for fold, (train_idx, eval_idx) in enumerate(splits):
+            trials.append({
+                "task": args.task,
+                "config_id": config_id,
+                "config": config,
+                "fold": fold,
+                "train_idx": train_idx.tolist(),
+                "eval_idx": eval_idx.tolist(),
+                "dataset_dir": dataset_dir,
+                "model_dir": model_dir,
+                "label_names": label_names,
+                "output_dir": os.path.join(cache_dir, "runs", f"config{config_id}_fold{fold}"),
+                "seed": args.seed,
+            })
+    print(f"{len(grid)} config(s) x {len(splits)} fold(s) = {len(trials)} trial(s)")
+
+    workers = args.workers or default_workers(args.threads_per_worker, args.trial_memory_gb)
+    workers = min(workers, len(trials))
+    print(f"{workers} worker(s) x {args.threads_per_worker} thread(s)\n")
+
+    start = time.perf_counter()
+    results = run_sweep(trials, workers, args.threads_per_worker)
+    elapsed = time.perf_counter() - start
+
+    results_df = pd.DataFrame(results).sort_values(["config_id", "fold"])
+    summary_df = summarize(results_df)
+
+    results_path = os.path.join(cache_dir, "sweep_results.csv")
+    summary_path = os.path.join(cache_dir, "sweep_summary.csv")
+    results_df.to_csv(results_path, index=False)
+    summary_df.to_csv(summary_path, index=False)
+
+    print("\n" + summary_df.to_string(index=False))
+    serial = results_df["wall_clock_s"].sum() if "wall_clock_s" in results_df else 0.0
+    print(f"\nSweep wall-clock: {elapsed:.1f}s (sum of trial times: {serial:.1f}s)")
+    print(f"✅ Results saved at: {results_path}")
+    print(f"✅ Summary saved at: {summary_path}")
+
+
+if __name__ == "__main__":
+    main()